@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import argparse
+import logging
 from pathlib import Path
 
 import rerun as rr
@@ -16,6 +17,7 @@ def main() -> None:
     parser.add_argument("--project", default=None, help="GCP project name")
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     bucket = args.bucket
     prefix = args.prefix
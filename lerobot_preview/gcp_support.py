@@ -2,115 +2,292 @@
 
 from __future__ import annotations
 
-import json
+import logging
+import os
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 
-import tqdm
+import numpy as np
+import orjson
 import xxhash
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
 
 # TODO make sure temp path is system agnostic
 DEST = Path("/tmp/rerun")
 
+# Blobs larger than this are fetched as concurrent range requests rather than a single stream
+LARGE_BLOB_SIZE = 64 << 20
+CHUNK_SIZE = 16 << 20
+
+# Transfers run on threads sharing one client, its connection pool must fit all of them
+MAX_WORKERS = 16
+POOL_MAXSIZE = 4 * MAX_WORKERS
+# Number of hosts to keep a connection pool for
+POOL_CONNECTIONS = 16
+
+# Bump whenever the layout of the cached metadata changes, so older caches get fetched again
+METADATA_VERSION = 2
 
-def load_json_l(path: Path) -> list[dict[str, Any]]:
-    with path.open("r", encoding="utf-8") as f:
-        return [json.loads(line) for line in f]
+# Files larger than this get their full size reserved before being written
+PREALLOCATE_SIZE = 1 << 20
 
 
 def index_from_name(name: str) -> int:
     """Extracts the episode index from a name of the form 'episode_{index}'."""
-    without_extension = Path(name).stem
-    if not without_extension.startswith("episode_"):
+    without_extension = name.rsplit(".", 1)[0]
+    index = without_extension[len("episode_") :]
+    if not without_extension.startswith("episode_") or not index.isdecimal():
         raise ValueError(f"Invalid episode name: {name}")
+    return int(index)
+
+
+def partial_path(dest: Path) -> Path:
+    """Returns where a download to dest is written until it is complete."""
+    return dest.with_name(dest.name + ".part")
+
+
+def write_file(path: Path, content: bytes) -> None:
+    """Writes the content to path, reserving the space for it up front if it is large."""
+    with open(path, "wb") as f:
+        if len(content) > PREALLOCATE_SIZE and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, len(content))
+        f.write(content)
+
+
+def append_file(path: Path, content: bytes) -> None:
+    """Appends the content to path with a single write, so concurrent appends don't interleave."""
+    # O_BINARY keeps Windows from translating newlines
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
     try:
-        return int(without_extension.split("_")[1])
-    except ValueError as e:
-        raise ValueError(f"Invalid episode name: {name}") from e
+        os.write(fd, content)
+    finally:
+        os.close(fd)
 
 
 class GCPLeRobot:
     def __init__(self, bucket: str, prefix: Path, project: str | None) -> None:
         self._prefix = prefix
+        # Object names always use forward slashes, whatever the local path flavour is.
+        # Includes the trailing slash, and is empty for datasets stored at the bucket root.
+        posix_prefix = prefix.as_posix().rstrip("/")
+        self._prefix_str = "" if posix_prefix == "." else f"{posix_prefix}/"
+        self._data_prefix_str = f"{self._prefix_str}data"
+        self._video_prefix_str = f"{self._prefix_str}videos"
+        # Where the dataset relative part of a blob name starts, for mirroring it into the cache
+        self._relative_name_start = len(self._prefix_str)
         self._project = project
         self._client = storage.Client(project=project)
+        # Widen the pool of the client's own session, rather than replacing it, to keep its credential setup
+        http = self._client._http
+        http.adapters["https://"].close()
+        http.mount("https://", HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE))
+        # Mounting dropped any client certificate adapter, redo the mTLS setup, it keeps the pool sizes
+        http.configure_mtls_channel(self._client._client_cert_source)
         self._bucket = self._client.bucket(bucket)
-        self._cache = DEST / str(xxhash.xxh64_hexdigest(f"{bucket}/{prefix}"))
+        self._cache = DEST / format(xxhash.xxh3_64_intdigest(f"{bucket}/{prefix}".encode()), "x")
         self._meta_cache = self._cache / "meta"
+        self._metadata_sentinel = str(self._meta_cache / f".metadata_ok_v{METADATA_VERSION}")
 
     @property
     def cache_dir(self) -> Path:
         """Returns the local cache directory that episodes will be stored in."""
         return self._cache
 
+    def _list_subdirs(self, prefix: str) -> list[str]:
+        """Lists the names of the immediate subdirectories of a bucket prefix."""
+        # Need trailing slash to get subdir names
+        iterator = self._bucket.list_blobs(prefix=prefix + "/", delimiter="/")
+        # Prefixes are only collected as the pages are consumed
+        list(iterator)
+        return [Path(subdir).name for subdir in iterator.prefixes]
+
+    def _map_episodes_to_subdirs(self) -> dict[str, str]:
+        """Maps every episode index to the data subdirectory that holds its parquet file."""
+        blobs = self._bucket.list_blobs(
+            prefix=f"{self._data_prefix_str}/",
+            match_glob=f"{self._data_prefix_str}/*/episode_*.parquet",
+            # Only the names are needed, keep the listing pages small
+            fields="items(name),nextPageToken",
+        )
+        episode_to_subdir: dict[str, str] = {}
+        for blob in blobs:
+            subdir, name = blob.name.rsplit("/", 2)[1:]
+            try:
+                episode_index = index_from_name(name)
+            except ValueError:
+                # Stray files such as renamed copies aren't episodes
+                continue
+            # JSON object keys are strings
+            episode_to_subdir[str(episode_index)] = subdir
+        if not episode_to_subdir:
+            raise ValueError(f"No episodes found at path {self._data_prefix_str}")
+        return episode_to_subdir
+
     def get_metadata(self) -> None:
         """Extracts LeRobot metadata from GCP and stores it in the local cache."""
-        if not (self._meta_cache).exists():
-            self._meta_cache.mkdir(parents=True, exist_ok=True)
-            # Download metadata
-            blobs = self._bucket.list_blobs(prefix=self._prefix / "meta")
-            for blob in tqdm.tqdm(blobs, desc="Downloading metadata"):
-                blob.download_to_filename(self._meta_cache / Path(blob.name).name)
-            shutil.move(self._meta_cache / "episodes.jsonl", self._meta_cache / "rerun_all_episodes.jsonl")
-            (self._meta_cache / "episodes.jsonl").touch()
-
-            # Avoid listing chunk dirs every time
-            # Need trailing slash to get subdir names
-            iterator = self._bucket.list_blobs(prefix=str(Path(self._prefix) / "data") + "/", delimiter="/")
-            print("Caching data subdirectory information…")
-            data_subdirectories = set()
-            for page in iterator.pages:
-                if page.prefixes:
-                    print(f"{page.prefixes=}")
-                    data_subdirectories.update(page.prefixes)
-            print(f"{data_subdirectories=}")
-            data_subdirs = list(Path(subdir).name for subdir in data_subdirectories)
-
-            video_subdirectories = set()
-            iterator = self._bucket.list_blobs(
-                prefix=str(Path(self._prefix) / "videos" / data_subdirs[0]) + "/",
-                delimiter="/",
+        # Only written once everything below succeeded, so interrupted runs are retried
+        if os.path.exists(self._metadata_sentinel):
+            return
+        self._meta_cache.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            # Avoid listing chunk dirs every time, list them while the metadata downloads
+            log.info("Caching data and video subdirectory information…")
+            episode_to_subdir_future = pool.submit(self._map_episodes_to_subdirs)
+            video_subdirs_future = pool.submit(
+                lambda: self._list_subdirs(
+                    f"{self._video_prefix_str}/{min(episode_to_subdir_future.result().values())}"
+                )
             )
-            print("Caching video subdirectory information…")
-            for page in iterator.pages:
-                if page.prefixes:
-                    video_subdirectories.update(page.prefixes)
-            video_subdirs = list(Path(subdir).name for subdir in video_subdirectories)
-            with open(self._meta_cache / "rerun_meta.json", "w", encoding="utf-8") as f:
-                json.dump({"subdirs": list(data_subdirs), "video_subdirs": list(video_subdirs)}, f)
-
-    def _maybe_download(self, blob: storage.Blob, dest: Path) -> None:
-        if not dest.parent.exists():
-            dest.parent.mkdir(parents=True, exist_ok=True)
-        if not dest.exists():
-            blob.download_to_filename(dest)
+
+            # Download metadata. These can't go through `client.batch()`: the batch endpoint
+            # only accepts JSON API calls, not media downloads, so they are parallelized instead.
+            blobs = list(self._bucket.list_blobs(prefix=f"{self._prefix_str}meta/"))
+            contents = pool.map(lambda blob: blob.download_as_bytes(), blobs)
+            for blob, content in zip(blobs, contents):
+                write_file(self._meta_cache / Path(blob.name).name, content)
+
+            episode_to_subdir = episode_to_subdir_future.result()
+            data_subdirs = sorted(set(episode_to_subdir.values()))
+            log.debug("data_subdirs=%s", data_subdirs)
+            video_subdirs = video_subdirs_future.result()
+        shutil.move(self._meta_cache / "episodes.jsonl", self._meta_cache / "rerun_all_episodes.jsonl")
+        self._index_all_episodes()
+        # Truncate rather than touch, a retried or outdated cache may have left entries behind
+        (self._meta_cache / "episodes.jsonl").write_bytes(b"")
+        # Indices of the episodes in episodes.jsonl, so membership checks don't need to parse it
+        (self._meta_cache / "episodes.index").write_bytes(b"")
+
+        (self._meta_cache / "rerun_meta.json").write_bytes(
+            orjson.dumps({
+                "subdirs": data_subdirs,
+                "video_subdirs": video_subdirs,
+                "episode_to_subdir": episode_to_subdir,
+            })
+        )
+        Path(self._metadata_sentinel).touch()
+
+    def _index_all_episodes(self) -> None:
+        """Records the byte offset of every line of rerun_all_episodes.jsonl, keyed by episode index."""
+        indices: list[int] = []
+        offsets: list[int] = []
+        offset = 0
+        with open(self._meta_cache / "rerun_all_episodes.jsonl", "rb") as f:
+            for line in f:
+                if line.strip():
+                    indices.append(orjson.loads(line)["episode_index"])
+                    offsets.append(offset)
+                offset += len(line)
+        # Missing episode indices are marked with -1
+        episode_offsets = np.full(max(indices, default=-1) + 1, -1, dtype=np.int64)
+        episode_offsets[indices] = offsets
+        np.save(self._meta_cache / "rerun_all_episodes.offsets.npy", episode_offsets)
+
+    def _load_episode(self, episode_index: int) -> dict[str, Any]:
+        """Reads the record of a single episode from rerun_all_episodes.jsonl."""
+        offsets = np.load(self._meta_cache / "rerun_all_episodes.offsets.npy")
+        if not 0 <= episode_index < len(offsets) or offsets[episode_index] < 0:
+            raise ValueError(f"Episode {episode_index} not found in episode metadata")
+        with open(self._meta_cache / "rerun_all_episodes.jsonl", "rb") as f:
+            f.seek(int(offsets[episode_index]))
+            episode: dict[str, Any] = orjson.loads(f.readline())
+        return episode
+
+    def _download_large_blob(self, blob: storage.Blob, dest: Path, checksum: str | None) -> None:
+        """Downloads a single large blob as concurrent byte-range slices."""
+        partial = partial_path(dest)
+        transfer_manager.download_chunks_concurrently(
+            blob,
+            str(partial),
+            chunk_size=CHUNK_SIZE,
+            # Without a checksum there's no point in decoding the payload either
+            download_kwargs={"raw_download": checksum is None},
+            worker_type=transfer_manager.THREAD,
+            max_workers=MAX_WORKERS,
+            # transfer_manager can't validate the combined checksum of KMS-encrypted objects
+            crc32c_checksum=checksum is not None and blob.kms_key_name is None,
+        )
+        os.replace(partial, dest)
+
+    def _download_blobs(
+        self, blob_file_pairs: list[tuple[storage.Blob, Path]], checksum: str | None = "crc32c"
+    ) -> None:
+        """Downloads all blobs in parallel, skipping cached ones. `checksum=None` skips validation and decoding."""
+        # Create each destination directory once, rather than per file in the workers
+        for parent in {dest.parent for _, dest in blob_file_pairs}:
+            parent.mkdir(parents=True, exist_ok=True)
+        small_pairs: list[tuple[storage.Blob, Path]] = []
+        large_pairs: list[tuple[storage.Blob, Path]] = []
+        for blob, dest in blob_file_pairs:
+            if dest.exists():
+                continue
+            if blob.size is None:
+                blob.reload()
+            (large_pairs if blob.size > LARGE_BLOB_SIZE else small_pairs).append((blob, dest))
+        # Keep every file that did arrive before reporting the first failure
+        errors: list[Exception] = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # Small blobs download alongside the large ones rather than waiting behind them
+            small_results = pool.submit(
+                transfer_manager.download_many,
+                [(blob, str(partial_path(dest))) for blob, dest in small_pairs],
+                download_kwargs={"checksum": checksum, "raw_download": checksum is None},
+                worker_type=transfer_manager.THREAD,
+                max_workers=MAX_WORKERS,
+            )
+            for blob, dest in large_pairs:
+                # Each large blob already saturates the worker pool with its own slices
+                try:
+                    self._download_large_blob(blob, dest, checksum)
+                except Exception as e:
+                    errors.append(e)
+            results = small_results.result()
+        for (_, dest), result in zip(small_pairs, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                os.replace(partial_path(dest), dest)
+        if errors:
+            raise errors[0]
 
     def get_contents(self, episode: str) -> None:
         """Downloads the data and video files for a given episode into the local cache."""
-        start = time.time()
-        episode_query = Path(self._prefix) / "data" / "**" / f"{episode}.parquet"
-        blobs = self._bucket.list_blobs(match_glob=episode_query)
-        print("Took", time.time() - start, "seconds to list parquets")
-        found_any = False
-        for blob in tqdm.tqdm(blobs, desc=f"Downloading data subdirectories for episode {episode}"):
-            found_any = True
-            dest = self._cache / Path(blob.name).relative_to(self._prefix)
-            self._maybe_download(blob, dest)
-        if not found_any:
-            raise ValueError(f"Episode {episode} not found at path {episode_query}")
-        start = time.time()
-        video_blobs = self._bucket.list_blobs(match_glob=Path(self._prefix) / "videos" / "**" / f"{episode}.mp4")
-        print("Took", time.time() - start, "seconds to list videos")
-        for video_blob in tqdm.tqdm(video_blobs, desc="Downloading videos"):
-            dest = self._cache / Path(video_blob.name).relative_to(self._prefix)
-            self._maybe_download(video_blob, dest)
-        all_episodes = load_json_l(self._meta_cache / "rerun_all_episodes.jsonl")
-        previous_episodes = load_json_l(self._meta_cache / "episodes.jsonl")
-        selected_episodes = [ep for ep in all_episodes if ep["episode_index"] == index_from_name(episode)]
-        if selected_episodes[0] not in previous_episodes:
-            with open(self._meta_cache / "episodes.jsonl", "a", encoding="utf-8") as outfile:
-                json.dump(selected_episodes[0], outfile)
-                outfile.write("\n")
+        target_idx = index_from_name(episode)
+        meta = orjson.loads((self._meta_cache / "rerun_meta.json").read_bytes())
+        subdir = meta["episode_to_subdir"].get(str(target_idx))
+        if subdir is None:
+            raise ValueError(f"Episode {episode} not found in {self._data_prefix_str}")
+        # The exact object names are known, so fetch them directly instead of globbing a listing
+        episode_path = f"{self._data_prefix_str}/{subdir}/{episode}.parquet"
+        video_prefix = f"{self._video_prefix_str}/{subdir}"
+        video_paths = [f"{video_prefix}/{video_subdir}/{episode}.mp4" for video_subdir in meta["video_subdirs"]]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            # Look up the videos while the parquet file is looked up and downloaded
+            start = time.time()
+            video_lookups = pool.map(self._bucket.get_blob, video_paths)
+            blob = self._bucket.get_blob(episode_path)
+            log.debug("Took %s seconds to look up parquets", time.time() - start)
+            if blob is None:
+                raise ValueError(f"Episode {episode} not found at path {episode_path}")
+            # Parquet files are small, so validating them is cheap
+            data_download = pool.submit(
+                self._download_blobs, [(blob, self._cache / blob.name[self._relative_name_start :])]
+            )
+            video_blobs = [video_blob for video_blob in video_lookups if video_blob is not None]
+            log.debug("Took %s seconds to look up videos", time.time() - start)
+            self._download_blobs(
+                [(blob, self._cache / blob.name[self._relative_name_start :]) for blob in video_blobs],
+                checksum=None,
+            )
+            data_download.result()
+        index_path = self._meta_cache / "episodes.index"
+        seen = set(map(int, index_path.read_text(encoding="utf-8").split())) if index_path.exists() else set()
+        if target_idx not in seen:
+            append_file(self._meta_cache / "episodes.jsonl", orjson.dumps(self._load_episode(target_idx)) + b"\n")
+            append_file(index_path, f"{target_idx}\n".encode())